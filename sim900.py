@@ -1,17 +1,39 @@
-from binascii import hexlify
-from collections import defaultdict, deque
+import os
+import re
+import termios
+from array import array
+from collections import deque
 from dataclasses import dataclass
 from datetime import datetime
-from operator import truth
+from fcntl import F_GETFL, F_SETFL, fcntl, ioctl
+from functools import lru_cache
+from select import POLLERR, POLLHUP, POLLIN, POLLNVAL, poll
 from sys import argv
-from time import sleep
+from time import monotonic
 
 from gsmmodem.pdu import EncodingError, decodeSmsPdu, encodeSmsSubmitPdu
-from serial import Serial
+from serial import Serial, SerialException
+
+
+class _Items:
+    """
+    (name, value) pairs for dict(obj), built on the first iteration.
+    The cache slot is kept out of the dataclass fields.
+    """
+
+    __slots__ = ("_items",)
+
+    def __iter__(self):
+        try:
+            items = self._items
+        except AttributeError:
+            items = self._build_items()
+            object.__setattr__(self, "_items", items)
+        return iter(items)
 
 
 @dataclass(slots=True, frozen=True)
-class Call:
+class Call(_Items):
     phone: str
     ts: datetime
 
@@ -20,43 +42,44 @@ class Call:
         date = datetime.now() if ts is None else ts
         object.__setattr__(self, "ts", date)
 
-    def __iter__(self):
-        for i in (("phone", self.phone), ("ts", self.ts.isoformat())):
-            yield i
+    def _build_items(self) -> tuple:
+        return (("phone", self.phone), ("ts", self.ts.isoformat()))
 
 
 @dataclass(slots=True, frozen=True)
-class Message:
+class Message(_Items):
     phone: str
     ts: datetime
     text: str
 
-    def __iter__(self):
-        for i in (
+    def _build_items(self) -> tuple:
+        return (
             ("phone", self.phone),
             ("ts", self.ts.isoformat()),
             ("text", self.text),
-        ):
-            yield i
+        )
 
 
 class AdditionMessages:
     def __init__(self) -> None:
-        self.m = defaultdict(dict)
+        self.m: dict[int, dict[int, str]] = {}
 
     def __call__(self, msg) -> Message | None:
         try:
             m = decodeSmsPdu(msg)
-            if d := m.get("udh"):
-                self.m[d[0].reference][d[0].number] = m["text"]
-                if len(self.m[d[0].reference].keys()) == d[0].parts:
-                    t = self.m.pop(d[0].reference)
-                    text = "".join(t[i] for i in sorted(t.keys()))
-                    return Message(m["number"], m["time"], text)
-                else:
-                    return None
-            else:
+            udh = m.get("udh")
+            if not udh:
                 return Message(m["number"], m["time"], m["text"])
+            d = udh[0]
+            ref_map = self.m.setdefault(d.reference, {})
+            ref_map[d.number] = m["text"]
+            parts = range(1, d.parts + 1)
+            # another sender may reuse the reference with other numbering
+            if len(ref_map) >= d.parts and all(i in ref_map for i in parts):
+                t = self.m.pop(d.reference)
+                text = "".join([t[i] for i in parts])
+                return Message(m["number"], m["time"], text)
+            return None
 
         except EncodingError:
             pass
@@ -79,21 +102,56 @@ class Sim900NoResponse(Exception):
         )
 
 
+# linux/serial.h: struct serial_struct, flags is the fifth int
+_ASYNC_LOW_LATENCY = 0x2000
+
+_OK = b"OK\r\n"
+_ERROR = b"ERROR\r\n"
+_PROMPT = b"> "
+# final result codes carrying an error number
+_CM_ERRORS = ("+CME ERROR:", "+CMS ERROR:")
+_CM_ERRORS_B = (b"+CME ERROR:", b"+CMS ERROR:")
+
+_CMD_ATH = b"ATH\r"
+_ESC = b"\x1b"  # cancels AT+CMGS text input
+
+# unsolicited result codes
+_RING = "RING"
+_CUSD = "+CUSD:"
+_CMTI = '+CMTI: "SM"'
+_NPD = "NORMAL POWER DOWN"
+
+_CLIP_RE = re.compile(r'\+CLIP:\s*"([^"]+)"')
+_CMTI_RE = re.compile(r'\+CMTI:\s*"SM",(\d+)')
+_CUSD_RE = re.compile(r'\+CUSD:\s*\d+,"([^"]*)"')
+
+
+@lru_cache(maxsize=64)
+def _enc(command: str) -> bytes:
+    return bytes(command + "\r", "utf-8")
+
+
+def _is_final(buf: bytearray, start: int, end: int, lines: tuple) -> bool:
+    """
+    Checks whether the line buf[start:end] is one of the final result
+    lines or a +CME/+CMS ERROR
+    """
+    return buf.startswith(_CM_ERRORS_B, start) or any(
+        end - start == len(t) and buf.startswith(t, start) for t in lines
+    )
+
+
 def decode(st: str) -> str:
-    r = ""
-    for i in range(int(len(st) / 4)):
-        a = i * 4
-        r += chr(int(st[a: a + 4], 16))
-    return r
+    return bytes.fromhex(st).decode("utf-16-be")
 
 
 def encode(st: str) -> str:
-    return hexlify(st.encode("utf-16-be")).decode("utf-8").upper()
+    return st.encode("utf-16-be").hex().upper()
 
 
 def parser_read(st: bytes) -> tuple[str]:
     if isinstance(st, bytes):
-        return tuple(filter(truth, st.decode("utf-8").split("\r\n")))
+        return tuple(line.decode("utf-8") for line in st.splitlines() if line)
     else:
         return tuple(st)
 
@@ -101,12 +159,13 @@ def parser_read(st: bytes) -> tuple[str]:
 class Sim900:
     def __init__(self, tty="/dev/ttyAMA0", speed=19200) -> None:
         self.serial = Serial
-        self._connect = self.serial(tty, speed)
         self.tty: str = tty
         self.speed: int = speed
         self.status: bool = False
         self.time_response: int = 3
+        self.time_send_sms: int = 10
         self.buffer: bytes | None = None
+        self._rxbuf = bytearray()  # received data not yet parsed
         self.auto_del_message = True
         self.operator: str | None = None
         self.rssi: str | None = None
@@ -117,31 +176,108 @@ class Sim900:
         self._a = AdditionMessages()  # sms processing
         self._many_sms: bool = False
         self._task_queue: deque = deque()
+        self._open()
+
+    def _open(self) -> None:
+        # short timeouts let reads return as soon as the modem stops sending
+        self._connect = self.serial(
+            self.tty, self.speed, timeout=0.05, inter_byte_timeout=0.02
+        )
+        self._set_low_latency()
+        self._fd = self._connect.fileno()
+        fcntl(self._fd, F_SETFL, fcntl(self._fd, F_GETFL) | os.O_NONBLOCK)
+        self._poll = poll()
+        self._poll.register(self._fd, POLLIN)
+
+    def _set_low_latency(self) -> None:
+        """
+        Disables the 16 ms latency timer of USB-serial adapters (FTDI).
+        Ports without TIOCGSERIAL support (ttyAMA0, pty, non-Linux systems)
+        are left as is.
+        """
+        get_serial = getattr(termios, "TIOCGSERIAL", None)
+        set_serial = getattr(termios, "TIOCSSERIAL", None)
+        if get_serial is None or set_serial is None:
+            return
+        buf = array("i", [0] * 32)
+        try:
+            fd = self._connect.fileno()
+            ioctl(fd, get_serial, buf, True)
+            buf[4] |= _ASYNC_LOW_LATENCY
+            ioctl(fd, set_serial, buf)
+        except OSError:
+            pass
 
     def connect(self):
-        self._connect = self.serial(self.tty, self.speed)
+        self._open()
         self.status = True
 
     def read(self) -> tuple[str]:
-        self.buffer = self._connect.read_all()
+        try:
+            data = os.read(self._fd, 4096)
+        except BlockingIOError:
+            data = None
+        if data == b"":
+            # readable but empty means the other end has gone
+            self.status = False
+            raise SerialException(
+                "device reports readiness to read but returned no data "
+                "(device disconnected?)"
+            )
+        if data:
+            self._rxbuf += data
+        # an incomplete last line is kept until the rest of it arrives
+        end = self._rxbuf.rfind(b"\n") + 1
+        with memoryview(self._rxbuf) as view:
+            self.buffer = bytes(view[:end])
+        del self._rxbuf[:end]
         return parser_read(self.buffer)
 
     def parser_command(self, data: tuple[str]) -> tuple[str]:
         self.checking_incoming_data(data)
         if len(data) == 0:
             raise Sim900NoResponse
-        elif data[-1] == "ERROR":
+        elif data[-1] == "ERROR" or data[-1].startswith(_CM_ERRORS):
             raise Sim900Error(self.buffer)
         else:
             return data[1:-1]
 
     def command(self, command: str) -> int | None:
-        return self._connect.write(bytes(command + "\r", "utf-8"))
+        return self._connect.write(_enc(command))
+
+    def _wait_for(self, *tokens: bytes, timeout: float | None = None) -> bytes:
+        """
+        Reads the port until a line equal to one of the tokens or
+        a +CME/+CMS ERROR line is received, the data ends with a token
+        that is not a line (the "> " prompt), or the timeout (by default
+        time_response) expires. Data after that point is left for read().
+        """
+        if timeout is None:
+            timeout = self.time_response
+        deadline = monotonic() + timeout
+        lines = tuple(t for t in tokens if t.endswith(b"\n"))
+        prompts = tuple(t for t in tokens if not t.endswith(b"\n"))
+        buf = self._rxbuf
+        pos = 0  # start of the first line not checked yet
+        stop = 0
+        while not stop and monotonic() < deadline:
+            buf += self._connect.read(self._connect.in_waiting or 1)
+            while not stop and (end := buf.find(b"\n", pos) + 1):
+                if _is_final(buf, pos, end, lines):
+                    stop = end
+                pos = end
+            if not stop and prompts and buf.endswith(prompts):
+                stop = len(buf)
+        if not stop:
+            stop = len(buf)
+        with memoryview(buf) as view:
+            self.buffer = bytes(view[:stop])
+        del buf[:stop]
+        return self.buffer
 
     def send_command(self, command: str) -> tuple:
         self.command(command)
-        sleep(self.time_response)
-        return self.parser_command(self.read())
+        return self.parser_command(parser_read(self._wait_for(_OK, _ERROR)))
 
     def get_operator(self) -> str:
         c = self.send_command("AT+COPS?")[0]
@@ -189,7 +325,8 @@ class Sim900:
 
     def get_all_sms_message(self) -> list[Message]:
         ms = self.send_command("AT+CMGL=4")
-        msg = [m for i in range(1, len(ms), 2) if (m := self._a(ms[i]))]
+        a = self._a
+        msg = [m for pdu in ms[1::2] if (m := a(pdu))]
         if self.auto_del_message:
             self.send_command("AT+CMGD=1,4")
         return msg
@@ -197,10 +334,24 @@ class Sim900:
     def send_sms(self, phone: str, text: str) -> None:
         for m in encodeSmsSubmitPdu(phone, text):
             self.command(f"AT+CMGS={m.tpduLength}")
-            sleep(0.5)
-            self._connect.write(bytes(str(m), "utf-8"))
-            sleep(0.5)
-            self.send_command(chr(26))
+            r = self._wait_for(_PROMPT, _ERROR)
+            if not r.endswith(_PROMPT):
+                data = parser_read(r)
+                if not data or (
+                    data[-1] != "ERROR"
+                    and not data[-1].startswith(_CM_ERRORS)
+                ):
+                    # the prompt may still come, leave the text input mode
+                    self._connect.write(_ESC)
+                # raises on an error result or on no response at all
+                self.parser_command(data)
+                raise Sim900Error(r)
+            self._connect.write(bytes(str(m) + chr(26), "utf-8"))
+            self.parser_command(
+                parser_read(
+                    self._wait_for(_OK, _ERROR, timeout=self.time_send_sms)
+                )
+            )
 
     def send_ussd(self, ussd: str) -> None:
         self.send_command(f'AT+CUSD=1,"{encode(ussd)}"')
@@ -221,7 +372,10 @@ class Sim900:
         return msg
 
     def hung_up_call(self):
-        return self.command("ATH")
+        n = self._connect.write(_CMD_ATH)
+        # consume the result so it is not taken for the next command's
+        self._wait_for(_OK, _ERROR)
+        return n
 
     def additional_function_message(self, msg: Message) -> None:
         pass
@@ -231,46 +385,58 @@ class Sim900:
 
     def incoming_call(self, data: tuple[str]) -> None:
         self.hung_up_call()
-        for d in filter(lambda x: "CLIP:" in x, data):
-            phone = d.replace('"', "").split(",")[0].split()[1]
-            c = Call(phone=phone)
-            self.additional_function_call(c)
+        for d in data:
+            if m := _CLIP_RE.match(d):
+                c = Call(phone=m.group(1))
+                self.additional_function_call(c)
 
     def __incoming_sms(self, sms_id: int) -> None:
         msg = self.get_sms(sms_id)
         if msg:
-            self._task_queue.append((self.additional_function_message, (msg,)))
+            self._task_queue.append((self.additional_function_message, msg))
 
     def incoming_message(self, data: tuple[str]) -> None:
-        for d in filter(lambda x: '+CMTI: "SM"' in x, data):
-            sms_id = int(d.split(",")[1])
-            if sms_id > 0:
-                self._many_sms = True
-            self._task_queue.append((self.__incoming_sms, (sms_id,)))
+        for d in data:
+            if m := _CMTI_RE.match(d):
+                sms_id = int(m.group(1))
+                if sms_id > 0:
+                    self._many_sms = True
+                self._task_queue.append((self.__incoming_sms, sms_id))
 
     def incoming_ussd(self, data: tuple[str]) -> None:
-        for d in filter(lambda x: "CUSD:" in x, data):
-            msg = Message(
-                phone="USSD",
-                ts=datetime.now(),
-                text=decode(d.split(",")[1].replace('"', "")),
-            )
-            self._task_queue.append((self.additional_function_message, (msg,)))
+        for d in data:
+            if m := _CUSD_RE.match(d):
+                msg = Message(
+                    phone="USSD",
+                    ts=datetime.now(),
+                    text=decode(m.group(1)),
+                )
+                self._task_queue.append(
+                    (self.additional_function_message, msg)
+                )
 
     def checking_incoming_data(self, st: tuple[str]) -> bool:
-        def checking(f: str, ls: tuple[str]) -> bool:
-            return any(map(lambda x: True if f in x else False, ls))
-
-        if checking("RING", st):
+        ring = cusd = cmti = npd = False
+        for line in st:
+            if _RING in line:
+                ring = True
+            elif _CUSD in line:
+                cusd = True
+            elif _CMTI in line:
+                cmti = True
+            elif _NPD in line:
+                npd = True
+
+        if ring:
             self.incoming_call(st)
 
-        if checking("CUSD:", st):
+        if cusd:
             self.incoming_ussd(st)
 
-        if checking('+CMTI: "SM"', st):
+        if cmti:
             self.incoming_message(st)
 
-        if checking("NORMAL POWER DOWN", st):
+        if npd:
             self.npd = True
             self.status = False
             return True
@@ -278,20 +444,28 @@ class Sim900:
 
     def run_task(self) -> bool:
         try:
-            task = self._task_queue.popleft()
-            task[0](*task[1])
-            return True
+            fn, arg = self._task_queue.popleft()
         except IndexError:
             return False
+        fn(arg)
+        return True
 
     def run(self):
         while self.npd is False:
             while len(self._task_queue) > 0:
                 self.run_task()
-            if self._connect.in_waiting > 0:
+            # lines left over after a command response
+            if b"\n" in self._rxbuf:
+                if self.checking_incoming_data(self.read()):
+                    return
+                continue
+            # blocks until the modem sends something
+            for _, event in self._poll.poll():
                 if self.checking_incoming_data(self.read()):
-                    break
-            sleep(0.5)
+                    return
+                if event & (POLLHUP | POLLERR | POLLNVAL):
+                    self.status = False
+                    raise SerialException("device disconnected")
 
 
 def simple_start(tty="/dev/ttyUSB0", speed: str | int = 19200) -> Sim900: